@@ -6,8 +6,10 @@ from melobot.handle import get_event
 from melobot.plugin import PluginLifeSpan
 from melobot.protocols.onebot.v11 import GroupMessageEvent, on_message
 
+from .migrate import MIGRATIONS, RETENTION_MIGRATIONS, Migrator
 from .msg import MsgDB, SegmentTag
 from .process import MessageStore
+from .retention import RETENTION_RULES, RetentionJob
 from .utils import get_id, init_conn
 
 REPLAYER = PluginPlanner("1.0.0")
@@ -18,6 +20,10 @@ class DataBases:
 
 
 MSG_STORE = MessageStore(DataBases.msg_db)
+MIGRATOR = Migrator(
+    DataBases.msg_db, [*MIGRATIONS, *(RETENTION_MIGRATIONS if len(RETENTION_RULES) else ())]
+)
+RETENTION = RetentionJob(DataBases.msg_db, MSG_STORE, RETENTION_RULES)
 
 
 async def start_db(logger: GenericLogger) -> None:
@@ -25,10 +31,23 @@ async def start_db(logger: GenericLogger) -> None:
     logger.info("所有数据库已完成初始化")
 
 
+async def run_background(logger: GenericLogger) -> None:
+    try:
+        await MIGRATOR.run()
+    except Exception:
+        logger.exception("执行数据库迁移时出现异常，下次启动时将从中断处继续")
+        return
+
+    # 保留策略依赖 RETENTION_MIGRATIONS 建立的索引，须在迁移完成后启动
+    if len(RETENTION_RULES):
+        await RETENTION.run_forever()
+
+
 @REPLAYER.on(PluginLifeSpan.INITED)
 async def prepare(logger: GenericLogger) -> None:
     await init_conn(logger)
     await start_db(logger)
+    asyncio.create_task(run_background(logger))
 
 
 @REPLAYER.use
@@ -0,0 +1,411 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Iterable, Sequence
+
+from melobot.log import GenericLogger, get_logger
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .msg import MEDIA_WHERE, MigrationRecord, MsgDB, Record
+
+TABLE = Record.__tablename__
+SHADOW = f"{TABLE}__shadow"
+RETIRED = f"{TABLE}__old"
+_PHYS_SUFFIX = re.compile(r"__v\d+$")
+_TABLE_HEAD = re.compile(rf'^CREATE TABLE\s+"?{TABLE}"?', re.IGNORECASE)
+_INDEX_HEAD = re.compile(
+    rf'^(CREATE (?:UNIQUE )?INDEX)\s+"?(\w+)"?\s+ON\s+"?{TABLE}"?', re.IGNORECASE
+)
+
+
+def logical_name(index: str) -> str:
+    """影子表重建会给索引加上 `__v<版本>` 后缀，此处还原为逻辑名"""
+    return _PHYS_SUFFIX.sub("", index)
+
+
+async def _scalar(conn: AsyncConnection, sql: str, **params: Any) -> Any:
+    return (await conn.execute(text(sql), params)).scalar()
+
+
+async def _indexes(conn: AsyncConnection) -> dict[str, str]:
+    rows = await conn.execute(
+        text("select name, sql from sqlite_master where type='index' and tbl_name=:t"),
+        {"t": TABLE},
+    )
+    return {name: sql for name, sql in rows if sql is not None}
+
+
+async def _columns(conn: AsyncConnection) -> list[str]:
+    return [r.name for r in await conn.execute(text(f"PRAGMA table_info({TABLE})"))]
+
+
+async def _physical_name(conn: AsyncConnection, index: str) -> str | None:
+    for name in await _indexes(conn):
+        if logical_name(name) == index:
+            return name
+    return None
+
+
+@dataclass(kw_only=True)
+class Migration(ABC):
+    version: int
+    name: str
+
+    @abstractmethod
+    async def apply(self, migrator: Migrator, state: MigrationRecord) -> None: ...
+
+
+@dataclass(kw_only=True)
+class ExecSQL(Migration):
+    """只适合执行很快的语句，它会在一个事务中持有写锁直到结束"""
+
+    sql: str
+
+    async def apply(self, migrator: Migrator, state: MigrationRecord) -> None:
+        async with migrator.db.engine.begin() as conn:
+            await migrator.save(conn, state, done=True)
+            await conn.exec_driver_sql(self.sql)
+
+
+@dataclass(kw_only=True)
+class DropIndex(Migration):
+    index: str
+
+    async def apply(self, migrator: Migrator, state: MigrationRecord) -> None:
+        async with migrator.db.engine.begin() as conn:
+            await migrator.save(conn, state, done=True)
+            phys = await _physical_name(conn, self.index)
+            if phys is not None:
+                await conn.exec_driver_sql(f'DROP INDEX "{phys}"')
+
+
+@dataclass(kw_only=True)
+class CreateIndex(Migration):
+    """在 segments 上后台建立索引
+
+    小表直接 `CREATE INDEX`。大表则使用影子表：建立带全部索引的影子表，
+    以触发器同步新的写入，再按 sid 分块复制旧数据，每块一个短事务，
+    块之间交还写锁给存储流程。之后在一个短事务中把原表改名换下、影子表改名就位，
+    两者都只修改表结构。sqlite 删除表时会逐页释放，耗时与表的大小成正比，
+    因此换下的原表同样分块删除，清空后再删除空表。
+    """
+
+    index: str
+    columns: Sequence[str]
+    where: str | None = None
+    unique: bool = False
+
+    def ddl(self, name: str, table: str) -> str:
+        head = "CREATE UNIQUE INDEX" if self.unique else "CREATE INDEX"
+        sql = f"{head} \"{name}\" ON {table} ({', '.join(self.columns)})"
+        return sql if self.where is None else f"{sql} WHERE {self.where}"
+
+    async def apply(self, migrator: Migrator, state: MigrationRecord) -> None:
+        # cursor 与影子表在同一事务中建立，为空说明影子表尚未建立
+        if state.cursor is None:
+            async with migrator.db.engine.begin() as conn:
+                if await _physical_name(conn, self.index) is not None:
+                    await migrator.save(conn, state, done=True)
+                    return
+
+                small = not await _scalar(
+                    conn,
+                    f"select count(*) from (select 1 from {TABLE} limit 1 offset :n)",
+                    n=migrator.chunk_size,
+                )
+                if small:
+                    await migrator.save(conn, state, done=True)
+                    await conn.exec_driver_sql(self.ddl(self.index, TABLE))
+                    return
+                await self._create_shadow(migrator, conn, state)
+
+        if state.total is None:
+            # 只在开始复制前统计一次，count 会读完最小的索引，不放在建立影子表的写事务中
+            async with migrator.db.engine.begin() as conn:
+                state.total = await _scalar(conn, f"select count(*) from {TABLE}")
+                await migrator.save(conn, state, done=False)
+
+        if not state.cleanup:
+            await self._copy(migrator, state)
+            await self._swap(migrator, state)
+        await self._cleanup(migrator, state)
+
+    async def _create_shadow(
+        self, migrator: Migrator, conn: AsyncConnection, state: MigrationRecord
+    ) -> None:
+        migrator.logger.info(
+            f"{TABLE} 表已有数据，迁移 {self.version} 将通过影子表在后台重建，"
+            "期间约需要与原表相同的额外磁盘空间"
+        )
+        # 事务内第一条语句须为 DML，sqlite3 驱动才会开启事务，之后的 DDL 才具有原子性
+        await migrator.save(conn, state, done=False)
+        table_sql = await _scalar(
+            conn, "select sql from sqlite_master where type='table' and name=:t", t=TABLE
+        )
+        await conn.exec_driver_sql(_TABLE_HEAD.sub(f"CREATE TABLE {SHADOW}", table_sql))
+
+        suffix = f"__v{self.version}"
+        for name, sql in (await _indexes(conn)).items():
+            phys = logical_name(name) + suffix
+            await conn.exec_driver_sql(_INDEX_HEAD.sub(rf'\1 "{phys}" ON {SHADOW}', sql))
+        await conn.exec_driver_sql(self.ddl(self.index + suffix, SHADOW))
+
+        cols = await _columns(conn)
+        col_list = ", ".join(cols)
+        new_list = ", ".join(f"NEW.{c}" for c in cols)
+        await conn.exec_driver_sql(
+            f"CREATE TRIGGER {SHADOW}_ins AFTER INSERT ON {TABLE} BEGIN "
+            f"INSERT OR REPLACE INTO {SHADOW} ({col_list}) VALUES ({new_list}); END"
+        )
+        await conn.exec_driver_sql(
+            f"CREATE TRIGGER {SHADOW}_upd AFTER UPDATE ON {TABLE} BEGIN "
+            f"DELETE FROM {SHADOW} WHERE sid = OLD.sid; "
+            f"INSERT OR REPLACE INTO {SHADOW} ({col_list}) VALUES ({new_list}); END"
+        )
+        await conn.exec_driver_sql(
+            f"CREATE TRIGGER {SHADOW}_del AFTER DELETE ON {TABLE} BEGIN "
+            f"DELETE FROM {SHADOW} WHERE sid = OLD.sid; END"
+        )
+
+        # 触发器建立后的写入都会被同步，因此只需复制此刻之前的数据
+        state.low = await _scalar(conn, f"select min(sid) from {TABLE}")
+        state.high = await _scalar(conn, f"select max(sid) from {TABLE}")
+        state.cursor = state.low - 1 if state.low is not None else 0
+        await migrator.save(conn, state, done=False)
+
+    async def _copy(self, migrator: Migrator, state: MigrationRecord) -> None:
+        assert state.cursor is not None
+        cols = None
+        last_log = time.monotonic()
+        while state.high is not None and state.cursor < state.high:
+            async with migrator.db.engine.begin() as conn:
+                if cols is None:
+                    cols = ", ".join(await _columns(conn))
+                end = await _scalar(
+                    conn,
+                    f"select max(sid) from (select sid from {TABLE} "
+                    "where sid > :cur and sid <= :high order by sid limit :n)",
+                    cur=state.cursor,
+                    high=state.high,
+                    n=migrator.chunk_size,
+                )
+                if end is None:
+                    end = state.high
+                res = await conn.execute(
+                    text(
+                        f"INSERT OR IGNORE INTO {SHADOW} ({cols}) SELECT {cols} FROM {TABLE} "
+                        "where sid > :cur and sid <= :end"
+                    ),
+                    {"cur": state.cursor, "end": end},
+                )
+                state.cursor = end
+                state.copied += max(res.rowcount, 0)
+                await migrator.save(conn, state, done=False)
+
+            if time.monotonic() - last_log >= migrator.log_interval:
+                last_log = time.monotonic()
+                migrator.logger.info(
+                    f"迁移 {self.version} 进度：{migrator.percent(state):.1f}%，"
+                    f"已复制 {state.copied} / 约 {state.total} 行"
+                )
+            await asyncio.sleep(migrator.pause)
+
+    async def _swap(self, migrator: Migrator, state: MigrationRecord) -> None:
+        state.cleanup = True
+        async with migrator.db.engine.begin() as conn:
+            await migrator.save(conn, state, done=False)
+            for suffix in ("ins", "upd", "del"):
+                await conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {SHADOW}_{suffix}")
+            await conn.exec_driver_sql(f"ALTER TABLE {TABLE} RENAME TO {RETIRED}")
+            await conn.exec_driver_sql(f"ALTER TABLE {SHADOW} RENAME TO {TABLE}")
+
+    async def _cleanup(self, migrator: Migrator, state: MigrationRecord) -> None:
+        migrator.logger.info(f"迁移 {self.version} 已切换到新表，开始分块删除换下的原表")
+        deleted = 0
+        last_log = time.monotonic()
+        while True:
+            async with migrator.db.engine.begin() as conn:
+                res = await conn.execute(
+                    text(
+                        f"delete from {RETIRED} where sid in "
+                        f"(select sid from {RETIRED} order by sid limit :n)"
+                    ),
+                    {"n": migrator.chunk_size},
+                )
+                if res.rowcount < migrator.chunk_size:
+                    # 剩余的行已在本事务中删除，此时删除空表很快
+                    await migrator.save(conn, state, done=True)
+                    await conn.exec_driver_sql(f"DROP TABLE {RETIRED}")
+                    return
+
+            deleted += res.rowcount
+            if time.monotonic() - last_log >= migrator.log_interval:
+                last_log = time.monotonic()
+                migrator.logger.info(f"迁移 {self.version} 已从原表删除 {deleted} 行")
+            await asyncio.sleep(migrator.pause)
+
+
+@dataclass(kw_only=True)
+class IndexCost:
+    """`bytes_per_row` 为平均每行在该索引中占用的字节数，近似于每次插入向该索引写入的数据量；
+    `size_share` 为该索引占表与全部索引总体积的比例，衡量的是磁盘占用而非单次写入量
+    """
+
+    name: str
+    columns: tuple[str, ...]
+    partial: bool
+    bytes: int | None
+    bytes_per_row: float | None
+    size_share: float | None
+    used_by: int
+
+
+class Migrator:
+    def __init__(
+        self,
+        db: MsgDB,
+        migrations: Iterable[Migration],
+        chunk_size: int = 5000,
+        pause: float = 0.05,
+        log_interval: float = 30,
+    ) -> None:
+        self.db = db
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        self.chunk_size = chunk_size
+        self.pause = pause
+        # 后台迁移可能持续数小时，至多每隔这么多秒输出一次进度
+        self.log_interval = log_interval
+
+        versions = [m.version for m in self.migrations]
+        if len(set(versions)) != len(versions):
+            raise ValueError(f"迁移版本号重复：{versions}")
+
+    @property
+    def logger(self) -> GenericLogger:
+        return get_logger()
+
+    async def save(self, conn: AsyncConnection, state: MigrationRecord, done: bool) -> None:
+        state.done = done
+        await conn.execute(
+            text(
+                "INSERT OR REPLACE INTO schema_migrations "
+                "(version, name, done, low, high, cursor, copied, total, cleanup) VALUES "
+                "(:version, :name, :done, :low, :high, :cursor, :copied, :total, :cleanup)"
+            ),
+            {
+                "version": state.version,
+                "name": state.name,
+                "done": state.done,
+                "low": state.low,
+                "high": state.high,
+                "cursor": state.cursor,
+                "copied": state.copied,
+                "total": state.total,
+                "cleanup": state.cleanup,
+            },
+        )
+
+    @staticmethod
+    def percent(state: MigrationRecord) -> float:
+        if state.done:
+            return 100.0
+        if state.low is None or state.high is None or state.cursor is None:
+            return 0.0
+        span = state.high - state.low + 1
+        return float(max(0.0, min(100.0, (state.cursor - state.low + 1) / span * 100)))
+
+    async def progress(self) -> list[MigrationRecord]:
+        async with self.db.engine.connect() as conn:
+            rows = await conn.execute(text("select * from schema_migrations"))
+            done = {r.version: MigrationRecord(**r._mapping) for r in rows}
+        return [
+            done.get(m.version, MigrationRecord(version=m.version, name=m.name))
+            for m in self.migrations
+        ]
+
+    async def run(self) -> None:
+        for state in await self.progress():
+            if state.done:
+                continue
+            migration = next(m for m in self.migrations if m.version == state.version)
+            self.logger.info(f"开始执行迁移 {migration.version}：{migration.name}")
+            await migration.apply(self, state)
+            self.logger.info(f"迁移 {migration.version} 已完成")
+
+    async def index_costs(self, queries: Iterable[str] = ()) -> list[IndexCost]:
+        """估算每个索引的代价：每次插入都要额外写一棵 B 树，索引项越大代价越高
+
+        需要通过 dbstat 读取所有 B 树，大库上耗时较长，应按需调用而不是每次启动时执行。
+        `queries` 中的语句会被 `EXPLAIN QUERY PLAN`，用于统计哪些索引真正被查询使用，
+        未提供查询时 `used_by` 没有意义。
+        """
+        async with self.db.engine.connect() as conn:
+            idxs = await _indexes(conn)
+            rows = await _scalar(conn, f"select count(*) from {TABLE}") or 0
+            sizes: dict[str, int | None] = {}
+            for name in (TABLE, *idxs):
+                try:
+                    sizes[name] = await _scalar(
+                        conn,
+                        "select sum(pgsize) from dbstat where name=:n and aggregate=TRUE",
+                        n=name,
+                    )
+                except Exception:
+                    sizes[name] = None
+                await conn.rollback()
+                await asyncio.sleep(self.pause)
+
+            used: dict[str, int] = {name: 0 for name in idxs}
+            for q in queries:
+                plan = " ".join(
+                    str(r[-1]) for r in await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {q}")
+                )
+                for name in idxs:
+                    if re.search(rf"\b{re.escape(name)}\b", plan):
+                        used[name] += 1
+
+            costs: list[IndexCost] = []
+            known = [v for v in sizes.values() if v is not None]
+            total = sum(known) if len(known) == len(sizes) else None
+            for name, sql in idxs.items():
+                cols = tuple(
+                    r[2] for r in await conn.exec_driver_sql(f'PRAGMA index_info("{name}")')
+                )
+                size = sizes[name]
+                costs.append(
+                    IndexCost(
+                        name=logical_name(name),
+                        columns=cols,
+                        partial=" WHERE " in sql.upper(),
+                        bytes=size,
+                        bytes_per_row=size / rows if size is not None and rows else None,
+                        size_share=size / total if size is not None and total else None,
+                        used_by=used[name],
+                    )
+                )
+        return sorted(costs, key=lambda c: c.bytes or 0, reverse=True)
+
+
+# 按版本号追加迁移，已完成的迁移不要修改或删除，例如：
+# CreateIndex(version=2, name="按群号查询", index="gid_time_idx", columns=("gid", "time"))
+MIGRATIONS: list[Migration] = []
+
+# 只在配置了保留规则时执行的迁移，版本号与 MIGRATIONS 共用，不能重复。
+# 媒体文件引用索引会给每次媒体入库多一次索引写入，不使用保留策略时没有必要。
+# 已有数据的库会走影子表重建，属于一次性的代价：重建期间约需要与原表相同的额外磁盘空间，
+# 而未启用 incremental auto_vacuum 的旧库无法归还换下的原表所占的页，
+# 它们只会留作空闲页供之后的写入复用，文件不会因此缩小。
+RETENTION_MIGRATIONS: list[Migration] = [
+    CreateIndex(
+        version=1,
+        name="媒体文件引用索引，供保留策略判断文件是否仍被引用",
+        index="media_idx",
+        columns=("data",),
+        where=MEDIA_WHERE,
+    ),
+]
@@ -1,10 +1,11 @@
+import math
 import os
+import time
 from asyncio import Lock
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from typing import AsyncGenerator
 
-from melobot.protocols.onebot.v11 import Segment
 from sqlalchemy.ext.asyncio.engine import create_async_engine
 from sqlmodel import Field, Index, SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
@@ -46,6 +47,27 @@ Index(
 Index("time_uid_idx", Record.time, Record.uid)  # type: ignore[arg-type]
 Index("time_scope_idx", Record.time, Record.gid, Record.uid)  # type: ignore[arg-type]
 
+# 媒体文件引用索引的条件，该索引只在配置了保留规则时由迁移建立，见 migrate.RETENTION_MIGRATIONS。
+# 查询须原样带上该条件，sqlite 才会使用部分索引
+MEDIA_WHERE = "type IN ('image', 'record', 'video', 'mface')"
+
+
+class MigrationRecord(SQLModel, table=True):
+    """记录每个版本迁移的进度，使后台迁移可在重启后继续"""
+
+    __tablename__ = "schema_migrations"
+    version: int = Field(primary_key=True)
+    name: str
+    done: bool = False
+    low: int | None = None
+    high: int | None = None
+    cursor: int | None = None
+    copied: int = 0
+    # 开始复制时原表的总行数，仅用于显示进度
+    total: int | None = None
+    # 影子表已就位，正在分块清理换下的原表
+    cleanup: bool = False
+
 
 @dataclass(kw_only=True)
 class SegmentTag:
@@ -57,10 +79,26 @@ class SegmentTag:
     nickname: str | None
 
 
-@dataclass(kw_only=True)
-class SegmentHandle(SegmentTag):
-    seg: Segment
-    idx: int
+class IngestMeter:
+    """以指数衰减估计最近的入库速率（条/秒），供后台任务据此限速"""
+
+    def __init__(self, halflife: float = 30) -> None:
+        self._decay = math.log(2) / halflife
+        self._rate = 0.0
+        self._last = time.monotonic()
+
+    def _advance(self) -> None:
+        now = time.monotonic()
+        self._rate *= math.exp(-self._decay * (now - self._last))
+        self._last = now
+
+    def hit(self, n: int) -> None:
+        self._advance()
+        self._rate += n * self._decay
+
+    def rate(self) -> float:
+        self._advance()
+        return self._rate
 
 
 class MsgDB:
@@ -75,6 +113,7 @@ class MsgDB:
         )
         self._started = False
         self._lock = Lock()
+        self.ingest = IngestMeter()
 
     def _prepare(self) -> None:
         self.root_dir = DB_DIR / "messages"
@@ -82,6 +121,7 @@ class MsgDB:
         self.audios_dir = self.root_dir / "audios"
         self.videos_dir = self.root_dir / "videos"
         self.mface_dir = self.root_dir / "mfaces"
+        self.cold_dir = self.root_dir / "cold"
         self.path = self.root_dir / "messages.db"
 
         if not self.root_dir.exists():
@@ -99,10 +139,12 @@ class MsgDB:
             if self._started:
                 return
             async with self.engine.begin() as conn:
+                # 只对尚未建表的新数据库生效，已有数据库需离线执行一次 VACUUM 才能切换
+                await conn.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
                 await conn.run_sync(
                     SQLModel.metadata.create_all,
                     tables=[
-                        SQLModel.metadata.tables[t.__tablename__] for t in (Record,)  # type: ignore[index]
+                        SQLModel.metadata.tables[t.__tablename__] for t in (Record, MigrationRecord)  # type: ignore[index]
                     ],
                     checkfirst=True,
                 )
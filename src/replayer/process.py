@@ -10,8 +10,10 @@ from melobot.protocols.onebot.v11 import Adapter, EchoRequireCtx, Segment
 from melobot.protocols.onebot.v11.adapter import segment as se
 from melobot.utils import semaphore, unfold_ctx
 
-from .msg import MsgDB, Record, SegmentHandle, SegmentTag
+from .msg import MsgDB, Record, SegmentTag
 from .utils import (
+    FACE_TEXT_TYPE,
+    MFACE_TYPE,
     AudioManager,
     FaceTextSegment,
     ImageManager,
@@ -32,6 +34,24 @@ class MessageStore:
         self.mface_manager = MFaceManager(self.db.mface_dir)
         self.adapter = cast(Adapter, get_bot().get_adapter(Adapter))
         assert self.adapter is not None, "初始化消息段存储器时，无法获取到 ob11 适配器"
+        self._init_dispatch()
+
+    def _init_dispatch(self) -> None:
+        self._sync_handlers: dict[str, Callable[[SegmentTag, Segment, int], Record]] = {
+            "text": self.text_handler,
+            FACE_TEXT_TYPE: self.facetxt_handler,
+            "at": self.at_handler,
+            "reply": self.reply_handler,
+        }
+        self._async_handlers: dict[
+            str, Callable[[SegmentTag, Segment, int, int], Coroutine[Any, Any, Record]]
+        ] = {
+            "image": self.image_handler,
+            "record": self.record_handler,
+            "video": self.video_handler,
+            "forward": self.forward_handler,  # type: ignore[dict-item]
+            MFACE_TYPE: self.mface_handler,
+        }
 
     @property
     def logger(self) -> GenericLogger:
@@ -41,32 +61,23 @@ class MessageStore:
         if depth > 10:
             raise ValueError(f"递归深度过深，放弃以下消息段的存储：{segs}")
 
+        recs: list[Record] = []
+        rec_ts: list[asyncio.Task[Record]] = []
         try:
-            new_segs = SegmentNormalizer.process(segs)
-            rec_ts: list[asyncio.Task[Record]] = []
-            for idx, seg in enumerate(new_segs):
-                handle = SegmentHandle(
-                    eid=tag.eid,
-                    mid=tag.mid,
-                    time=tag.time,
-                    gid=tag.gid,
-                    uid=tag.uid,
-                    nickname=tag.nickname,
-                    seg=seg,
-                    idx=idx,
-                )
-                handler = cast(
-                    Callable[[SegmentHandle, int], Coroutine[Any, Any, Record]] | None,
-                    getattr(self, f"{seg.type}_handler", None),
-                )
-                if handler:
-                    rec_ts.append(asyncio.create_task(handler(handle, depth)))
+            sync_handlers, async_handlers = self._sync_handlers, self._async_handlers
+            # 只有需要 I/O 的消息段才创建任务，其余直接同步生成记录
+            for idx, seg in enumerate(SegmentNormalizer.process(segs)):
+                a_handler = async_handlers.get(seg.type)
+                if a_handler is None:
+                    recs.append(sync_handlers.get(seg.type, self.handler)(tag, seg, idx))
                 else:
-                    rec_ts.append(asyncio.create_task(self.handler(handle, depth)))
+                    rec_ts.append(asyncio.create_task(a_handler(tag, seg, idx, depth)))
 
             if len(rec_ts):
                 dones, _ = await asyncio.wait(rec_ts)
-                await self.commit((t.result() for t in dones))
+                recs.extend(t.result() for t in dones)
+            if len(recs):
+                await self.commit(recs)
                 if depth > 0:
                     self.logger.debug(f"进入存储过程的 {depth} 次递归")
                 self.logger.debug(
@@ -74,6 +85,10 @@ class MessageStore:
                 )
 
         except Exception:
+            # 同步处理方法或某个任务出错时，取消其余仍在进行的 I/O 任务并取回它们的结果
+            for t in rec_ts:
+                t.cancel()
+            await asyncio.gather(*rec_ts, return_exceptions=True)
             self.logger.exception("存储消息段时出现异常")
             self.logger.generic_obj(
                 "异常点局部变量",
@@ -81,57 +96,54 @@ class MessageStore:
                     "tag": tag,
                     "segs": tuple(s.to_dict() for s in segs),
                     "depth": depth,
-                    "recs": tuple(d.result() for d in dones) if "dones" in locals() else (),
+                    "recs": tuple(recs),
                 },
                 level=LogLevel.ERROR,
             )
 
     @semaphore(value=8)
     async def commit(self, recs: Iterable[Record]) -> None:
+        recs = list(recs)
         async with self.db.session() as session:
             try:
                 session.add_all(recs)
                 await session.commit()
             except sqlite3.IntegrityError as e:
                 self.logger.warning(f"出现完整性错误，具体信息：{e}")
+        self.db.ingest.hit(len(recs))
 
-    async def text_handler(self, handle: SegmentHandle, _: int) -> Record:
-        return make_record(handle, handle.seg.type, text=handle.seg.data["text"])
+    def text_handler(self, tag: SegmentTag, seg: Segment, idx: int) -> Record:
+        return make_record(tag, idx, seg.type, text=seg.data["text"])
 
-    async def facetxt_handler(self, handle: SegmentHandle, _: int) -> Record:
-        return make_record(
-            handle,
-            handle.seg.type,
-            text=handle.seg.data["text"],
-            data=repr(handle.seg.data),
-        )
+    def facetxt_handler(self, tag: SegmentTag, seg: Segment, idx: int) -> Record:
+        return make_record(tag, idx, seg.type, text=seg.data["text"], data=repr(seg.data))
 
-    async def image_handler(self, handle: SegmentHandle, _: int) -> Record:
-        seg = cast(se.ImageRecvSegment, handle.seg)
-        md5 = await self.image_manager.store(seg.data["url"], handle.time)
-        return make_record(handle, seg.type, data=md5)
+    async def image_handler(self, tag: SegmentTag, seg: Segment, idx: int, _: int) -> Record:
+        seg = cast(se.ImageRecvSegment, seg)
+        md5 = await self.image_manager.store(seg.data["url"], tag.time)
+        return make_record(tag, idx, seg.type, data=md5)
 
-    async def record_handler(self, handle: SegmentHandle, _: int) -> Record:
+    async def record_handler(self, tag: SegmentTag, seg: Segment, idx: int, _: int) -> Record:
         """注意这是语音消息段的处理方法，名称中的 record 与 Record 无关"""
-        seg = cast(se.RecordRecvSegment, handle.seg)
-        md5 = await self.audio_manager.store(seg.data["url"], handle.time)
-        return make_record(handle, seg.type, data=md5)
+        seg = cast(se.RecordRecvSegment, seg)
+        md5 = await self.audio_manager.store(seg.data["url"], tag.time)
+        return make_record(tag, idx, seg.type, data=md5)
 
-    async def video_handler(self, handle: SegmentHandle, _: int) -> Record:
-        seg = cast(se.VideoRecvSegment, handle.seg)
-        md5 = await self.video_manager.store(seg.data["url"], handle.time)
-        return make_record(handle, seg.type, data=md5)
+    async def video_handler(self, tag: SegmentTag, seg: Segment, idx: int, _: int) -> Record:
+        seg = cast(se.VideoRecvSegment, seg)
+        md5 = await self.video_manager.store(seg.data["url"], tag.time)
+        return make_record(tag, idx, seg.type, data=md5)
 
-    async def at_handler(self, handle: SegmentHandle, _: int) -> Record:
-        return make_record(handle, handle.seg.type, data=repr(handle.seg.data))
+    def at_handler(self, tag: SegmentTag, seg: Segment, idx: int) -> Record:
+        return make_record(tag, idx, seg.type, data=repr(seg.data))
 
-    async def reply_handler(self, handle: SegmentHandle, _: int) -> Record:
-        seg = cast(se.ReplySegment, handle.seg)
-        return make_record(handle, seg.type, data=seg.data["id"])
+    def reply_handler(self, tag: SegmentTag, seg: Segment, idx: int) -> Record:
+        seg = cast(se.ReplySegment, seg)
+        return make_record(tag, idx, seg.type, data=seg.data["id"])
 
     @unfold_ctx(lambda: EchoRequireCtx().unfold(True))
-    async def forward_handler(self, handle: SegmentHandle, depth: int) -> Record:
-        seg = cast(se.ForwardSegment, handle.seg)
+    async def forward_handler(self, tag: SegmentTag, seg: Segment, idx: int, depth: int) -> Record:
+        seg = cast(se.ForwardSegment, seg)
         hs = await self.adapter.get_forward_msg(seg.data["id"])
         echo = await hs[0]
         assert echo is not None
@@ -139,14 +151,14 @@ class MessageStore:
         data = echo.data
         if data is None:
             self.logger.warning(f"转发消息 {seg.data['id']} 获取失败，放弃后续的递归存储")
-            return make_record(handle, seg.type)
+            return make_record(tag, idx, seg.type)
 
         msgs = data["message"]
         ts: list[asyncio.Task[None]] = []
         eids: list[int] = []
         for node_seg in msgs:
             eid = get_id()
-            tag = SegmentTag(
+            node_tag = SegmentTag(
                 eid=eid,
                 mid=None,
                 time=None,
@@ -155,61 +167,62 @@ class MessageStore:
                 nickname=node_seg.data["nickname"],  # type: ignore
             )
             eids.append(eid)
-            coro = self.process(node_seg.data["content"], tag, depth + 1)  # type: ignore[typeddict-item]
+            coro = self.process(node_seg.data["content"], node_tag, depth + 1)  # type: ignore[typeddict-item]
             ts.append(asyncio.create_task(coro))
         if len(ts):
             await asyncio.wait(ts)
-        return make_record(handle, seg.type, data=repr(eids))
+        return make_record(tag, idx, seg.type, data=repr(eids))
 
-    async def mface_handler(self, handle: SegmentHandle, _: int) -> Record:
-        seg = cast(MfaceSegment, handle.seg)  # type: ignore
-        md5 = await self.mface_manager.store(seg.data["url"], handle.time)
-        return make_record(handle, handle.seg.type, data=md5)
+    async def mface_handler(self, tag: SegmentTag, seg: Segment, idx: int, _: int) -> Record:
+        seg = cast(MfaceSegment, seg)  # type: ignore
+        md5 = await self.mface_manager.store(seg.data["url"], tag.time)
+        return make_record(tag, idx, seg.type, data=md5)
 
-    async def handler(self, handle: SegmentHandle, depth: int) -> Record:
-        return make_record(handle, handle.seg.type, data=handle.seg.to_json())
+    def handler(self, tag: SegmentTag, seg: Segment, idx: int) -> Record:
+        return make_record(tag, idx, seg.type, data=seg.to_json())
 
 
 class SegmentNormalizer:
     @classmethod
-    def _join_face_text(self, segs: list[Segment]) -> FaceTextSegment | se.TextSegment:  # type: ignore
-        if len(segs) == 1 and isinstance(segs[0], se.TextSegment):
-            return segs[0]
-        if all(isinstance(s, se.TextSegment) for s in segs):
+    def _join_face_text(
+        self, segs: list[Segment], has_face: bool
+    ) -> FaceTextSegment | se.TextSegment:  # type: ignore
+        if not has_face:
+            if len(segs) == 1:
+                return cast(se.TextSegment, segs[0])
             return se.TextSegment("".join(s.data["text"] for s in segs))
 
         text_list: list[str] = []
         face_list: list[int] = []
         for seg in segs:
-            if isinstance(seg, se.FaceSegment):
+            if seg.type == "face":
                 text_list.append("\u0000")
                 face_list.append(seg.data["id"])
             else:
-                text_list.append(cast(se.TextSegment, seg).data["text"].replace("\u0000", ""))
+                text_list.append(seg.data["text"].replace("\u0000", ""))
         return FaceTextSegment(text="".join(text_list), faces=repr(face_list))  # type: ignore
 
     @classmethod
     def gen_face_text(self, segs: list[Segment]) -> list[Segment]:
-        start, end = -1, -1
+        # 单次遍历，将连续的文本与表情段合并为一段
         new_segs: list[Segment] = []
-        for idx, seg in enumerate(segs):
-            if isinstance(seg, (se.FaceSegment, se.TextSegment)):
-                if start == -1:
-                    start = idx
-                else:
-                    end = idx
+        run: list[Segment] = []
+        has_face = False
+        for seg in segs:
+            t = seg.type
+            if t == "text":
+                run.append(seg)
+            elif t == "face":
+                run.append(seg)
+                has_face = True
             else:
-                if start != -1:
-                    if end == -1:
-                        end = start
-                    new_segs.append(self._join_face_text(segs[start : end + 1]))
-                    start, end = -1, -1
+                if run:
+                    new_segs.append(self._join_face_text(run, has_face))
+                    run, has_face = [], False
                 new_segs.append(seg)
 
-        if start != -1:
-            if end == -1:
-                end = start
-            new_segs.append(self._join_face_text(segs[start : end + 1]))
+        if run:
+            new_segs.append(self._join_face_text(run, has_face))
         return new_segs
 
     @classmethod
@@ -0,0 +1,322 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from ast import literal_eval
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Iterable
+
+from melobot.log import GenericLogger, get_logger
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .msg import MEDIA_WHERE, MsgDB, Record
+from .process import MessageStore
+from .utils import MFACE_TYPE, BinaryDataManager
+
+TABLE = Record.__tablename__
+_MIN_KEY = -(1 << 63)
+
+
+@dataclass(kw_only=True)
+class RetentionRule:
+    """`type` 为消息段类型，`gid` 为群号，为空表示任意；`days` 为空表示永久保留
+
+    一条消息段只受最具体的规则约束，群号比类型更具体。转发消息内的消息段没有时间与群号，
+    按其所属顶层消息段的时间与群号匹配规则；转发消息段过期时，其包含的全部消息段随之过期。
+    """
+
+    type: str | None = None
+    gid: int | None = None
+    days: int | None = None
+
+    @property
+    def rank(self) -> int:
+        return (self.gid is not None) * 2 + (self.type is not None)
+
+    def overlaps(self, other: RetentionRule) -> bool:
+        return (self.gid is None or other.gid is None or self.gid == other.gid) and (
+            self.type is None or other.type is None or self.type == other.type
+        )
+
+    def matches(self, gid: int | None, type: str) -> bool:
+        return (self.gid is None or self.gid == gid) and (self.type is None or self.type == type)
+
+
+def _month_range(timestamp: int) -> tuple[int, int]:
+    date = datetime.fromtimestamp(timestamp)
+    lo = datetime(date.year, date.month, 1)
+    hi = datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+    return int(lo.timestamp()), int(hi.timestamp())
+
+
+class RetentionJob:
+    def __init__(
+        self,
+        db: MsgDB,
+        store: MessageStore,
+        rules: Iterable[RetentionRule],
+        interval: float = 3600,
+        batch_size: int = 500,
+        vacuum_pages: int = 256,
+        pause: float = 0.2,
+        max_rate: float = 50,
+    ) -> None:
+        self.db = db
+        self.rules = sorted(rules, key=lambda r: r.rank)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.max_rate = max_rate
+        self.managers: dict[str, BinaryDataManager] = {
+            "image": store.image_manager,
+            "record": store.audio_manager,
+            "video": store.video_manager,
+            MFACE_TYPE: store.mface_manager,
+        }
+        self._warned = False
+
+        keys = [(r.gid, r.type) for r in self.rules]
+        if len(set(keys)) != len(keys):
+            raise ValueError(f"存在重复的保留规则：{self.rules}")
+
+    @property
+    def logger(self) -> GenericLogger:
+        return get_logger()
+
+    async def throttle(self) -> None:
+        """入库繁忙时暂停，否则按当前入库速率延长批次间的间隔"""
+        while (rate := self.db.ingest.rate()) > self.max_rate:
+            self.logger.debug(f"入库速率 {rate:.1f} 条/秒，保留任务暂停")
+            await asyncio.sleep(self.pause * 10)
+        await asyncio.sleep(self.pause * (1 + rate / self.max_rate))
+
+    async def run_forever(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                self.logger.exception("执行保留策略时出现异常")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> None:
+        now = time.time()
+        for rule in self.rules:
+            if rule.days is None:
+                continue
+            deleted = await self.expire(rule, int(now - rule.days * 86400))
+            if deleted:
+                self.logger.info(f"保留规则 {rule} 已清理 {deleted} 条消息段")
+        deleted = await self.expire_forwarded(now)
+        if deleted:
+            self.logger.info(f"已清理转发消息中过期的 {deleted} 条消息段")
+        await self.vacuum()
+
+    def expired(self, gid: int | None, type: str, timestamp: int, now: float) -> bool:
+        for rule in reversed(self.rules):
+            if rule.matches(gid, type):
+                return rule.days is not None and timestamp < now - rule.days * 86400
+        return False
+
+    def _where(self, rule: RetentionRule) -> tuple[str, dict[str, Any]]:
+        conds = ["time < :cutoff"]
+        params: dict[str, Any] = {}
+        if rule.gid is not None:
+            conds.append("gid = :gid")
+            params["gid"] = rule.gid
+        if rule.type is not None:
+            conds.append("type = :type")
+            params["type"] = rule.type
+
+        # 排除由更具体的规则负责的部分
+        for i, other in enumerate(self.rules):
+            if other.rank <= rule.rank or not rule.overlaps(other):
+                continue
+            parts = []
+            if other.gid is not None:
+                parts.append(f"gid = :x_gid{i}")
+                params[f"x_gid{i}"] = other.gid
+            if other.type is not None:
+                parts.append(f"type = :x_type{i}")
+                params[f"x_type{i}"] = other.type
+            conds.append(f"NOT ({' AND '.join(parts)})")
+        return " AND ".join(conds), params
+
+    async def expire(self, rule: RetentionRule, cutoff: int) -> int:
+        where, params = self._where(rule)
+        params.update(cutoff=cutoff, n=self.batch_size, last_time=_MIN_KEY, last_sid=_MIN_KEY)
+        # 以 (time, sid) 为游标逐批推进，被保留的行只会扫描一次
+        select_sql = text(
+            f"select sid, eid, type, time, gid, data from {TABLE} where {where} "
+            "and (time, sid) > (:last_time, :last_sid) order by time, sid limit :n"
+        )
+
+        total = 0
+        while True:
+            await self.throttle()
+            async with self.db.engine.connect() as conn:
+                rows = list((await conn.execute(select_sql, params)).all())
+                if not rows:
+                    break
+                params.update(last_time=rows[-1].time, last_sid=rows[-1].sid)
+                # 过期转发消息包含的消息段无法再被访问，一并删除
+                rows.extend(await self._descendants(conn, rows, None))
+            await self.remove(rows)
+            total += len(rows)
+        return total
+
+    async def expire_forwarded(self, now: float) -> int:
+        """转发消息内的消息段时间与群号为空，不会被 `expire` 选中，
+        此处遍历仍保留的顶层转发消息，按它的时间与群号判断其中的消息段是否过期
+        """
+        days = [r.days for r in self.rules if r.days is not None]
+        if not days:
+            return 0
+        params: dict[str, Any] = dict(
+            cutoff=int(now - min(days) * 86400),
+            n=self.batch_size,
+            last_time=_MIN_KEY,
+            last_sid=_MIN_KEY,
+        )
+        select_sql = text(
+            f"select sid, eid, type, time, gid, data from {TABLE} "
+            "where type = 'forward' and time < :cutoff "
+            "and (time, sid) > (:last_time, :last_sid) order by time, sid limit :n"
+        )
+
+        total = 0
+        while True:
+            await self.throttle()
+            async with self.db.engine.connect() as conn:
+                parents = (await conn.execute(select_sql, params)).all()
+                if not parents:
+                    break
+                params.update(last_time=parents[-1].time, last_sid=parents[-1].sid)
+                rows = await self._descendants(conn, parents, now)
+            if rows:
+                await self.remove(rows)
+                total += len(rows)
+        return total
+
+    async def _descendants(
+        self, conn: AsyncConnection, parents: Iterable[Any], now: float | None
+    ) -> list[Any]:
+        """逐层查找转发消息段 `parents` 包含的消息段
+
+        `now` 为空表示 `parents` 已过期，返回全部后代；否则按顶层消息段的时间与群号匹配规则，
+        只返回过期的消息段，以及过期转发消息段的全部后代。
+        """
+        stmt = text(
+            f"select sid, eid, type, time, data from {TABLE} where eid in :eids"
+        ).bindparams(bindparam("eids", expanding=True))
+        found: list[Any] = []
+        # 每项为 (转发消息段, 顶层群号, 顶层时间, 是否已过期)
+        level = [(p, p.gid, p.time, now is None) for p in parents]
+        while level:
+            owners: dict[int, tuple[int | None, int, bool]] = {}
+            for row, gid, timestamp, doomed in level:
+                if row.type == "forward" and row.data:
+                    for eid in literal_eval(row.data):
+                        owners[eid] = (gid, timestamp, doomed)
+
+            level = []
+            eids = list(owners)
+            for i in range(0, len(eids), self.batch_size):
+                rows = await conn.execute(stmt, {"eids": eids[i : i + self.batch_size]})
+                for row in rows:
+                    gid, timestamp, doomed = owners[row.eid]
+                    if not doomed and now is not None:
+                        doomed = self.expired(gid, row.type, timestamp, now)
+                    if doomed:
+                        found.append(row)
+                    level.append((row, gid, timestamp, doomed))
+        return found
+
+    async def remove(self, rows: list[Any]) -> None:
+        """先归档再删除：归档失败时本批记录保留，下次运行会重试"""
+        sids = [r.sid for r in rows]
+        media = [r for r in rows if r.type in self.managers and r.data]
+        if media:
+            await self.archive(media, sids)
+        delete_sql = text(f"delete from {TABLE} where sid in :sids").bindparams(
+            bindparam("sids", expanding=True)
+        )
+        async with self.db.engine.begin() as conn:
+            for i in range(0, len(sids), self.batch_size):
+                await conn.execute(delete_sql, {"sids": sids[i : i + self.batch_size]})
+
+    async def _referenced(
+        self,
+        conn: AsyncConnection,
+        type: str,
+        month: tuple[int, int] | None,
+        md5s: set[str],
+        sids: list[int],
+    ) -> set[str]:
+        # 同一目录内的文件按 md5 去重，可能仍被同月其他未过期的消息段引用；
+        # 转发消息内的文件都存放在同一目录，需检查所有时间为空的消息段
+        scope = "time is null" if month is None else "time >= :lo and time < :hi"
+        stmt = text(
+            f"select distinct data from {TABLE} where {MEDIA_WHERE} and type = :type "
+            f"and data in :md5s and {scope} and sid not in :sids"
+        ).bindparams(bindparam("md5s", expanding=True), bindparam("sids", expanding=True))
+        params: dict[str, Any] = {"type": type, "md5s": list(md5s), "sids": sids}
+        if month is not None:
+            params.update(lo=month[0], hi=month[1])
+        return {r.data for r in await conn.execute(stmt, params)}
+
+    async def archive(self, rows: list[Any], sids: list[int]) -> None:
+        """归档即将删除的 `rows` 所引用的媒体文件，`sids` 为本批将删除的全部记录"""
+        groups: dict[tuple[str, tuple[int, int] | None], dict[str, int | None]] = {}
+        for r in rows:
+            month = None if r.time is None else _month_range(r.time)
+            groups.setdefault((r.type, month), {})[r.data] = r.time
+
+        moved = 0
+        for (type, month), entries in groups.items():
+            async with self.db.engine.connect() as conn:
+                kept = await self._referenced(conn, type, month, set(entries), sids)
+            manager = self.managers[type]
+            for md5, timestamp in entries.items():
+                if md5 in kept:
+                    continue
+                if await asyncio.to_thread(manager.archive, md5, timestamp, self.db.cold_dir):
+                    moved += 1
+        if moved:
+            self.logger.debug(f"已将 {moved} 个过期媒体文件移入冷存储")
+
+    async def vacuum(self) -> None:
+        async with self.db.engine.connect() as conn:
+            mode = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+        if mode != 2:
+            if self._warned:
+                return
+            self._warned = True
+            self.logger.warning(
+                "数据库未启用 incremental auto_vacuum，空闲页只会被复用而不会归还，"
+                "如需缩小文件，请停止记录后设置 PRAGMA auto_vacuum = INCREMENTAL 并执行一次 VACUUM"
+            )
+            return
+
+        while await self.vacuum_step():
+            await self.throttle()
+
+    async def vacuum_step(self) -> bool:
+        """归还至多 `vacuum_pages` 个空闲页，返回是否仍有空闲页"""
+        async with self.db.engine.connect() as conn:
+            free = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+            if not free:
+                return False
+            # 通过 execute 执行时每次只会释放一页，executescript 才会执行完整个 pragma
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.executescript(  # type: ignore[union-attr]
+                f"PRAGMA incremental_vacuum({self.vacuum_pages});"
+            )
+        return bool(free > self.vacuum_pages)
+
+
+# 按需添加保留规则，例如视频保留 90 天，文本永久保留：
+# RetentionRule(type="video", days=90)
+RETENTION_RULES: list[RetentionRule] = []
@@ -1,7 +1,9 @@
 import asyncio
+import gzip
 import hashlib
 import logging
 import os
+import shutil
 import ssl
 from contextlib import asynccontextmanager
 from datetime import datetime
@@ -14,7 +16,7 @@ from melobot.log import GenericLogger, Logger, LogLevel, get_logger
 from melobot.protocols.onebot.v11 import Adapter, Segment
 from melobot.utils.common import _DEFAULT_ID_WORKER
 
-from .msg import Record, SegmentHandle
+from .msg import Record, SegmentTag
 
 SSL_CONTEXT = ssl.create_default_context()
 SSL_CONTEXT.set_ciphers("DEFAULT")
@@ -49,23 +51,24 @@ def get_id() -> int:
 
 
 def make_record(
-    sh: SegmentHandle,
+    tag: SegmentTag,
+    idx: int,
     type: str,
     text: str | None = None,
     data: str | None = None,
 ) -> Record:
     return Record(
         sid=get_id(),
-        time=sh.time,
-        eid=sh.eid,
-        mid=sh.mid,
-        gid=sh.gid,
-        uid=sh.uid,
+        time=tag.time,
+        eid=tag.eid,
+        mid=tag.mid,
+        gid=tag.gid,
+        uid=tag.uid,
         type=type,
         text=text,
-        nickname=sh.nickname,
+        nickname=tag.nickname,
         data=data,
-        idx=sh.idx,
+        idx=idx,
     )
 
 
@@ -150,7 +153,9 @@ async def ahttp(
 
 class BinaryDataManager:
     APPID_NOT_MATCH = b'{"retcode":-5503023,"retmsg":"appid is not match","retryflag":1}'
-    NOT_ENOUGH_DATA = "ContentLengthError: 400, message='Not enough data for satisfy content length header.'"
+    NOT_ENOUGH_DATA = (
+        "ContentLengthError: 400, message='Not enough data for satisfy content length header.'"
+    )
 
     def __init__(self, root_path: str | Path):
         self.root = (
@@ -165,6 +170,28 @@ class BinaryDataManager:
     def logger(self) -> GenericLogger:
         return get_logger()
 
+    def dir_of(self, timestamp: int | None) -> Path:
+        if timestamp:
+            date = datetime.fromtimestamp(timestamp)
+            return self.root / str(date.year) / str(date.month)
+        return self.default_dir
+
+    def archive(self, md5: str, timestamp: int | None, cold_root: Path) -> bool:
+        """将数据压缩移动到冷存储目录，阻塞操作，应在线程中运行"""
+        src = self.dir_of(timestamp) / f"{md5}.bin"
+        if not src.exists():
+            return False
+
+        dst_dir = cold_root / self.root.name / src.parent.relative_to(self.root)
+        os.makedirs(str(dst_dir), exist_ok=True)
+        dst = dst_dir / f"{md5}.bin.gz"
+        tmp = dst.with_suffix(".tmp")
+        with open(src, "rb") as in_fp, gzip.open(tmp, "wb", compresslevel=6) as out_fp:
+            shutil.copyfileobj(in_fp, out_fp)
+        os.replace(tmp, dst)
+        os.remove(src)
+        return True
+
     async def store(self, url: str, timestamp: int | None) -> str:
         md5 = ""
         try:
@@ -186,12 +213,8 @@ class BinaryDataManager:
                             await asyncio.sleep(delay)
                             continue
 
-                        if timestamp:
-                            date = datetime.fromtimestamp(timestamp)
-                            img_dir = self.root / str(date.year) / str(date.month)
-                            os.makedirs(str(img_dir), exist_ok=True)
-                        else:
-                            img_dir = self.default_dir
+                        img_dir = self.dir_of(timestamp)
+                        os.makedirs(str(img_dir), exist_ok=True)
 
                         md5 = hashlib.md5(content).hexdigest()
                         img_path = img_dir / f"{md5}.bin"
@@ -213,7 +236,9 @@ class BinaryDataManager:
                         raise
 
                 except Exception:
-                    self.logger.exception(f"{idx} | 存储数据时发生错误，时间：{timestamp}，源：{url}")
+                    self.logger.exception(
+                        f"{idx} | 存储数据时发生错误，时间：{timestamp}，源：{url}"
+                    )
                     await asyncio.sleep(delay)
 
             else:
@@ -0,0 +1,68 @@
+import asyncio
+import sys
+import time
+from typing import Any, Awaitable, Callable
+
+sys.path.insert(0, "../src")
+
+from melobot import Bot, Logger, LogLevel
+from melobot.ctx import BotCtx, LoggerCtx
+from melobot.protocols.onebot.v11 import ForwardWebSocketIO, OneBotV11Protocol, Segment
+from melobot.protocols.onebot.v11.adapter import segment as se
+
+# 消息段存储的单条消息开销基准，只测规范化、分发与记录生成，不访问数据库
+BOT = Bot("bench")
+BOT.add_protocol(OneBotV11Protocol(ForwardWebSocketIO("ws://127.0.0.1:12359")))
+with BotCtx().unfold(BOT):
+    from legacy import LegacyDispatcher, LegacySegmentNormalizer
+
+    from replayer.msg import SegmentTag
+    from replayer.process import MessageStore, SegmentNormalizer
+
+ROUNDS = 4000
+REPEAT = 5
+MESSAGES = {
+    "单段文本": [se.TextSegment("hello world")],
+    "文本 + at + 回复": [se.ReplySegment("1"), se.AtSegment(2), se.TextSegment("hello world")],
+    "文本与表情混排": [se.TextSegment("a"), se.FaceSegment(1), se.TextSegment("b")],
+}
+
+
+class BenchStore(MessageStore):
+    def __init__(self) -> None:
+        self._init_dispatch()
+
+    async def commit(self, recs: Any) -> None:
+        list(recs)
+
+
+async def timeit(fn: Callable[[list[Segment]], Awaitable[Any] | Any], segs: list[Segment]) -> float:
+    """取多轮中最快一轮的单次平均耗时（微秒），以减小噪声"""
+    costs: list[float] = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            res = fn(segs)
+            if asyncio.iscoroutine(res):
+                await res
+        costs.append((time.perf_counter() - start) / ROUNDS * 1e6)
+    return min(costs)
+
+
+async def bench() -> None:
+    store = BenchStore()
+    legacy = LegacyDispatcher(store)
+    tag = SegmentTag(eid=1, mid=1, time=1, gid=1, uid=1, nickname="bench")
+    for name, segs in MESSAGES.items():
+        old_norm = await timeit(LegacySegmentNormalizer.process, segs)
+        new_norm = await timeit(SegmentNormalizer.process, segs)
+        old = await timeit(lambda s: legacy.process(s, tag), segs)
+        new = await timeit(lambda s: store.process(s, tag), segs)
+        print(
+            f"{name}：规范化 {old_norm:.2f} -> {new_norm:.2f} us，"
+            f"完整流程 {old:.2f} -> {new:.2f} us"
+        )
+
+
+with BotCtx().unfold(BOT), LoggerCtx().unfold(Logger("bench", LogLevel.WARNING)):
+    asyncio.run(bench())
@@ -0,0 +1,60 @@
+import sys
+from pathlib import Path
+from typing import Any
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, str(Path(__file__).parent.parent.joinpath("src")))
+
+from melobot import Bot, Logger, LogLevel
+from melobot.ctx import BotCtx, LoggerCtx
+from melobot.protocols.onebot.v11 import ForwardWebSocketIO, OneBotV11Protocol
+
+# replayer 的部分模块在导入时就需要 bot 与 logger 上下文
+BOT = Bot("test")
+BOT.add_protocol(OneBotV11Protocol(ForwardWebSocketIO("ws://127.0.0.1:12359")))
+BotCtx().add(BOT)
+LoggerCtx().add(Logger("test", LogLevel.WARNING))
+
+from replayer import msg
+from replayer.msg import MsgDB, Record
+
+
+@pytest.fixture
+def msg_db(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> MsgDB:
+    # replayer.utils 会把引擎日志写到相对于工作目录的 replayer/logs
+    tmp_path.joinpath("replayer", "logs").mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(msg, "DB_DIR", tmp_path)
+    db = MsgDB()
+    db.engine.echo = False
+    return db
+
+
+def make_rec(sid: int, **kwargs: Any) -> Record:
+    fields: dict[str, Any] = dict(
+        sid=sid,
+        time=sid,
+        eid=sid,
+        mid=sid,
+        gid=1,
+        uid=1,
+        type="text",
+        text=f"text {sid}",
+        nickname=None,
+        data=None,
+        idx=0,
+    )
+    fields.update(kwargs)
+    return Record(**fields)
+
+
+async def add_recs(db: MsgDB, recs: list[Record]) -> None:
+    async with db.session() as session:
+        session.add_all(recs)
+
+
+async def fetch(db: MsgDB, sql: str, **params: Any) -> list[Any]:
+    async with db.engine.connect() as conn:
+        return list((await conn.execute(text(sql), params)).all())
@@ -0,0 +1,33 @@
+import asyncio
+import sys
+from pathlib import Path
+from string import Template
+
+sys.path.insert(0, "../src")
+
+from replayer.migrate import MIGRATIONS, Migrator
+from replayer.msg import MsgDB
+
+# 按需输出索引代价报告，会读取整个数据库文件，请在记录负载较低时运行
+# 用法：python index_cost.py ["额外的查询语句" ...]
+SQL_DIR = Path("../src/replayer/sql")
+
+# 以 replayer 实际使用的查询作为负载，判断索引是否被用到
+WORKLOAD = [
+    Template(SQL_DIR.joinpath("seg_ctx.sql").read_text(encoding="utf-8")).substitute(
+        cond="mid = 0", gid=0, lof=10, rof=10
+    ),
+    *sys.argv[1:],
+]
+
+
+async def main() -> None:
+    db = MsgDB()
+    db.engine.echo = False
+    await db.start()
+    for cost in await Migrator(db, MIGRATIONS).index_costs(WORKLOAD):
+        print(cost)
+    await db.engine.dispose()
+
+
+asyncio.run(main())
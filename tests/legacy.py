@@ -0,0 +1,125 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Callable, Coroutine, cast
+
+from melobot.protocols.onebot.v11 import Segment
+from melobot.protocols.onebot.v11.adapter import segment as se
+
+from replayer.msg import Record, SegmentTag
+from replayer.process import MessageStore
+from replayer.utils import FaceTextSegment, make_record
+
+# 改动前的消息段规范化与分发流程，仅作为等价性测试与基准测试的参照，不要修改
+
+
+@dataclass(kw_only=True)
+class SegmentHandle(SegmentTag):
+    seg: Segment
+    idx: int
+
+
+class LegacySegmentNormalizer:
+    @classmethod
+    def _join_face_text(self, segs: list[Segment]) -> FaceTextSegment | se.TextSegment:  # type: ignore
+        if len(segs) == 1 and isinstance(segs[0], se.TextSegment):
+            return segs[0]
+        if all(isinstance(s, se.TextSegment) for s in segs):
+            return se.TextSegment("".join(s.data["text"] for s in segs))
+
+        text_list: list[str] = []
+        face_list: list[int] = []
+        for seg in segs:
+            if isinstance(seg, se.FaceSegment):
+                text_list.append("\u0000")
+                face_list.append(seg.data["id"])
+            else:
+                text_list.append(cast(se.TextSegment, seg).data["text"].replace("\u0000", ""))
+        return FaceTextSegment(text="".join(text_list), faces=repr(face_list))  # type: ignore
+
+    @classmethod
+    def gen_face_text(self, segs: list[Segment]) -> list[Segment]:
+        start, end = -1, -1
+        new_segs: list[Segment] = []
+        for idx, seg in enumerate(segs):
+            if isinstance(seg, (se.FaceSegment, se.TextSegment)):
+                if start == -1:
+                    start = idx
+                else:
+                    end = idx
+            else:
+                if start != -1:
+                    if end == -1:
+                        end = start
+                    new_segs.append(self._join_face_text(segs[start : end + 1]))
+                    start, end = -1, -1
+                new_segs.append(seg)
+
+        if start != -1:
+            if end == -1:
+                end = start
+            new_segs.append(self._join_face_text(segs[start : end + 1]))
+        return new_segs
+
+    @classmethod
+    def process(self, segs: list[Segment]) -> list[Segment]:
+        new_segs = self.gen_face_text(segs)
+        return new_segs
+
+
+class LegacyDispatcher:
+    """只保留不涉及 I/O 的处理方法，每段仍构造句柄、按名称查找并各自创建任务"""
+
+    def __init__(self, store: MessageStore) -> None:
+        self.store = store
+
+    async def process(self, segs: list[Segment], tag: SegmentTag, depth: int = 0) -> None:
+        new_segs = LegacySegmentNormalizer.process(segs)
+        rec_ts: list[asyncio.Task[Record]] = []
+        for idx, seg in enumerate(new_segs):
+            handle = SegmentHandle(
+                eid=tag.eid,
+                mid=tag.mid,
+                time=tag.time,
+                gid=tag.gid,
+                uid=tag.uid,
+                nickname=tag.nickname,
+                seg=seg,
+                idx=idx,
+            )
+            handler = cast(
+                Callable[[SegmentHandle, int], Coroutine[Any, Any, Record]] | None,
+                getattr(self, f"{seg.type}_handler", None),
+            )
+            if handler:
+                rec_ts.append(asyncio.create_task(handler(handle, depth)))
+            else:
+                rec_ts.append(asyncio.create_task(self.handler(handle, depth)))
+
+        if len(rec_ts):
+            dones, _ = await asyncio.wait(rec_ts)
+            await self.store.commit((t.result() for t in dones))
+            self.store.logger.debug(
+                f"事件 {tag.eid} 已完成存储，消息段类型：[{', '.join((s.type for s in segs))}]"
+            )
+
+    async def text_handler(self, handle: SegmentHandle, _: int) -> Record:
+        return make_record(handle, handle.idx, handle.seg.type, text=handle.seg.data["text"])
+
+    async def facetxt_handler(self, handle: SegmentHandle, _: int) -> Record:
+        return make_record(
+            handle,
+            handle.idx,
+            handle.seg.type,
+            text=handle.seg.data["text"],
+            data=repr(handle.seg.data),
+        )
+
+    async def at_handler(self, handle: SegmentHandle, _: int) -> Record:
+        return make_record(handle, handle.idx, handle.seg.type, data=repr(handle.seg.data))
+
+    async def reply_handler(self, handle: SegmentHandle, _: int) -> Record:
+        seg = cast(se.ReplySegment, handle.seg)
+        return make_record(handle, handle.idx, seg.type, data=seg.data["id"])
+
+    async def handler(self, handle: SegmentHandle, _: int) -> Record:
+        return make_record(handle, handle.idx, handle.seg.type, data=handle.seg.to_json())
@@ -0,0 +1,256 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+from replayer import migrate
+from replayer.migrate import CreateIndex, DropIndex, Migration, Migrator
+from replayer.msg import MsgDB
+
+from .conftest import add_recs, fetch, make_rec
+
+
+class _Crash(Exception):
+    pass
+
+
+def _patch_sleep(
+    monkeypatch: pytest.MonkeyPatch, hook: Callable[[int], Awaitable[None]] | None = None
+) -> list[int]:
+    """替换块之间的让出点，在其中模拟写入或中断，返回已完成的块数"""
+    calls: list[int] = []
+
+    async def sleep(_: float) -> None:
+        calls.append(len(calls))
+        if hook is not None:
+            await hook(len(calls))
+
+    monkeypatch.setattr(migrate, "asyncio", SimpleNamespace(sleep=sleep))
+    return calls
+
+
+async def _names(db: MsgDB, type: str) -> set[str]:
+    rows = await fetch(db, "select name from sqlite_master where type = :t", t=type)
+    return {r.name for r in rows}
+
+
+async def _sids(db: MsgDB) -> set[int]:
+    return {r.sid for r in await fetch(db, "select sid from segments")}
+
+
+def test_migration_is_abstract() -> None:
+    with pytest.raises(TypeError):
+        Migration(version=1, name="abstract")  # type: ignore[abstract]
+
+
+def test_small_table_creates_index_directly(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 11)])
+        migrator = Migrator(
+            msg_db, [CreateIndex(version=1, name="gid", index="gid_idx", columns=("gid",))]
+        )
+        (state,) = await migrator.progress()
+        assert not state.done and migrator.percent(state) == 0
+
+        await migrator.run()
+        assert "gid_idx" in await _names(msg_db, "index")
+        assert migrate.SHADOW not in await _names(msg_db, "table")
+        (state,) = await migrator.progress()
+        assert state.done and state.cursor is None and migrator.percent(state) == 100
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_shadow_rebuild_keeps_concurrent_writes(
+    msg_db: MsgDB, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    async def write(chunk: int) -> None:
+        async with msg_db.engine.begin() as conn:
+            await conn.exec_driver_sql(
+                "insert into segments (sid, time, eid, uid, type, idx) "
+                f"values ({10000 + chunk}, 1, 1, 1, 'text', 0)"
+            )
+            if chunk == 2:
+                # 已复制与未复制的行各删除一条，并更新一条、补入一条 sid 更小的迟到数据
+                await conn.exec_driver_sql("delete from segments where sid in (5, 1900)")
+                await conn.exec_driver_sql("update segments set text = 'edited' where sid = 1000")
+                await conn.exec_driver_sql(
+                    "insert into segments (sid, time, eid, uid, type, idx) "
+                    "values (0, 1, 1, 1, 'text', 0)"
+                )
+
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 2001)])
+        migrator = Migrator(
+            msg_db,
+            [CreateIndex(version=1, name="gid", index="gid_idx", columns=("gid", "time"))],
+            chunk_size=100,
+        )
+        chunks = _patch_sleep(monkeypatch, write)
+        await migrator.run()
+
+        # 复制 20 块；换下的原表共 2019 行，清理时前 20 块之后各让出一次
+        assert len(chunks) == 40
+        expected = set(range(0, 2001)) - {5, 1900} | {10000 + i for i in range(1, 41)}
+        assert await _sids(msg_db) == expected
+        (row,) = await fetch(msg_db, "select text from segments where sid = 1000")
+        assert row.text == "edited"
+
+        indexes = await _names(msg_db, "index")
+        assert "gid_idx__v1" in indexes and "cover_idx__v1" in indexes
+        assert not {n for n in indexes if not n.startswith("sqlite_") and "__v1" not in n}
+        assert not {migrate.SHADOW, migrate.RETIRED} & await _names(msg_db, "table")
+        assert not await _names(msg_db, "trigger")
+
+        (state,) = await migrator.progress()
+        # sid 1000 已由触发器同步，复制时被忽略；sid 1900 在复制前已删除
+        assert state.done and state.copied == 1998 and migrator.percent(state) == 100
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_shadow_rebuild_resumes_from_saved_cursor(
+    msg_db: MsgDB, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    async def crash(chunk: int) -> None:
+        if chunk == 3:
+            raise _Crash
+
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 1001)])
+        migrations = [CreateIndex(version=1, name="gid", index="gid_idx", columns=("gid",))]
+
+        _patch_sleep(monkeypatch, crash)
+        with pytest.raises(_Crash):
+            await Migrator(msg_db, migrations, chunk_size=100).run()
+
+        migrator = Migrator(msg_db, migrations, chunk_size=100)
+        (state,) = await migrator.progress()
+        assert not state.done and state.cursor == 300 and state.copied == 300
+        assert state.total == 1000
+        assert migrator.percent(state) == 30
+        assert migrate.SHADOW in await _names(msg_db, "table")
+
+        chunks = _patch_sleep(monkeypatch)
+        await migrator.run()
+        # 复制剩余的 7 块，清理原表的 10 块
+        assert len(chunks) == 17
+        assert await _sids(msg_db) == set(range(1, 1001))
+        (state,) = await migrator.progress()
+        assert state.done and state.copied == 1000
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_retired_table_cleanup_resumes(msg_db: MsgDB, monkeypatch: pytest.MonkeyPatch) -> None:
+    async def crash(chunk: int) -> None:
+        if chunk == 12:
+            raise _Crash
+
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 1001)])
+        migrations = [CreateIndex(version=1, name="gid", index="gid_idx", columns=("gid",))]
+
+        # 复制 10 块后换表，清理原表两块后中断
+        _patch_sleep(monkeypatch, crash)
+        with pytest.raises(_Crash):
+            await Migrator(msg_db, migrations, chunk_size=100).run()
+
+        migrator = Migrator(msg_db, migrations, chunk_size=100)
+        (state,) = await migrator.progress()
+        assert state.cleanup and not state.done
+        assert "gid_idx__v1" in await _names(msg_db, "index")
+        assert await _sids(msg_db) == set(range(1, 1001))
+        (row,) = await fetch(msg_db, f"select count(*) as n from {migrate.RETIRED}")
+        assert row.n == 800
+
+        chunks = _patch_sleep(monkeypatch)
+        await migrator.run()
+        assert len(chunks) == 8
+        assert migrate.RETIRED not in await _names(msg_db, "table")
+        (state,) = await migrator.progress()
+        assert state.done
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_copy_progress_is_logged_at_info(msg_db: MsgDB, monkeypatch: pytest.MonkeyPatch) -> None:
+    logs: list[str] = []
+    fake = SimpleNamespace(info=logs.append, debug=lambda _: None)
+    monkeypatch.setattr(Migrator, "logger", property(lambda _: fake))
+
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 301)])
+        _patch_sleep(monkeypatch)
+        migrations = [CreateIndex(version=1, name="gid", index="gid_idx", columns=("gid",))]
+        await Migrator(msg_db, migrations, chunk_size=100, log_interval=0).run()
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+    progress = [line for line in logs if "已复制" in line]
+    assert progress == [
+        f"迁移 1 进度：{pct:.1f}%，已复制 {n} / 约 300 行"
+        for pct, n in ((100 / 3, 100), (200 / 3, 200), (100, 300))
+    ]
+    assert any("已从原表删除 100 行" in line for line in logs)
+
+
+def test_drop_index_resolves_versioned_name(msg_db: MsgDB, monkeypatch: pytest.MonkeyPatch) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 301)])
+        _patch_sleep(monkeypatch)
+        migrations: list[Migration] = [
+            CreateIndex(version=1, name="gid", index="gid_idx", columns=("gid",)),
+            DropIndex(version=2, name="drop cover", index="cover_idx"),
+        ]
+        await Migrator(msg_db, migrations, chunk_size=100).run()
+
+        indexes = await _names(msg_db, "index")
+        assert "gid_idx__v1" in indexes
+        assert not {n for n in indexes if migrate.logical_name(n) == "cover_idx"}
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_index_costs_counts_query_usage(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i) for i in range(1, 101)])
+        costs = {
+            c.name: c
+            for c in await Migrator(msg_db, [], pause=0).index_costs(
+                ["select eid from segments where eid = 1"]
+            )
+        }
+        assert costs["ix_segments_eid"].used_by == 1
+        assert costs["time_scope_idx"].used_by == 0
+        assert costs["cover_idx"].partial and not costs["time_scope_idx"].partial
+        shares: list[Any] = [c.size_share for c in costs.values()]
+        if None not in shares:
+            assert 0 < sum(shares) < 1
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_media_index_only_built_by_retention_migration(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        assert "media_idx" not in await _names(msg_db, "index")
+        await Migrator(msg_db, [*migrate.MIGRATIONS, *migrate.RETENTION_MIGRATIONS]).run()
+        assert "media_idx" in await _names(msg_db, "index")
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
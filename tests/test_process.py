@@ -0,0 +1,82 @@
+import asyncio
+import gc
+import random
+from typing import Any
+
+from melobot.protocols.onebot.v11 import Segment
+from melobot.protocols.onebot.v11.adapter import segment as se
+
+from replayer.msg import MsgDB, Record, SegmentTag
+from replayer.process import MessageStore, SegmentNormalizer
+
+from .legacy import LegacySegmentNormalizer
+
+TAG = SegmentTag(eid=1, mid=1, time=1, gid=1, uid=1, nickname="test")
+
+
+def _random_seg(rand: random.Random) -> Segment:
+    kind = rand.randrange(4)
+    if kind == 0:
+        return se.TextSegment(rand.choice(["a", "bc", "d\u0000e", "\u0000", ""]))
+    if kind == 1:
+        return se.FaceSegment(rand.randint(1, 5))
+    if kind == 2:
+        return se.AtSegment(rand.randint(1, 5))
+    return se.ReplySegment(str(rand.randint(1, 5)))
+
+
+def test_normalizer_matches_legacy() -> None:
+    rand = random.Random(20241019)
+    for _ in range(20000):
+        segs = [_random_seg(rand) for _ in range(rand.randint(0, 8))]
+        expected = [s.to_dict() for s in LegacySegmentNormalizer.process(segs)]
+        assert [s.to_dict() for s in SegmentNormalizer.process(segs)] == expected
+
+
+def test_single_text_is_passed_through() -> None:
+    seg = se.TextSegment("hello")
+    assert SegmentNormalizer.process([seg])[0] is seg
+
+
+def test_sync_handler_error_cancels_io_tasks(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        store = MessageStore(msg_db)
+        io_coros: list[Any] = []
+        committed: list[Record] = []
+        unretrieved: list[dict[str, Any]] = []
+        asyncio.get_running_loop().set_exception_handler(lambda _, ctx: unretrieved.append(ctx))
+
+        async def download() -> Record:
+            await asyncio.sleep(60)
+            raise AssertionError("unreachable")
+
+        def slow_io(*_: Any) -> Any:
+            io_coros.append(download())
+            return io_coros[-1]
+
+        async def failed_io(*_: Any) -> Record:
+            raise OSError("download failed")
+
+        def broken(*_: Any) -> Record:
+            raise ValueError("broken handler")
+
+        async def commit(recs: Any) -> None:
+            committed.extend(recs)
+
+        store._async_handlers["at"] = slow_io
+        store._async_handlers["reply"] = failed_io
+        store._sync_handlers["text"] = broken
+        store.commit = commit  # type: ignore[method-assign]
+
+        segs = [se.AtSegment(1), se.ReplySegment("2"), se.TextSegment("x")]
+        await store.process(segs, TAG)
+
+        await asyncio.sleep(0)
+        # 被取消的任务不会再继续下载，协程已结束
+        assert len(io_coros) == 1 and io_coros[0].cr_frame is None
+        assert not committed
+        gc.collect()
+        await asyncio.sleep(0)
+        assert not unretrieved
+
+    asyncio.run(main())
@@ -0,0 +1,252 @@
+import asyncio
+import gzip
+import time
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from replayer.msg import MsgDB, Record
+from replayer.process import MessageStore
+from replayer.retention import RetentionJob, RetentionRule
+
+from .conftest import add_recs, fetch, make_rec
+
+DAY = 86400
+NOW = int(time.time())
+
+
+def _job(db: MsgDB, rules: list[RetentionRule], **kwargs: int) -> RetentionJob:
+    return RetentionJob(db, MessageStore(db), rules, pause=0, **kwargs)
+
+
+async def _rows(db: MsgDB) -> set[tuple[int | None, str, int]]:
+    rows = await fetch(db, "select gid, type, time from segments")
+    return {(r.gid, r.type, (NOW - r.time) // DAY) for r in rows}
+
+
+def _store_file(job: RetentionJob, type: str, md5: str, timestamp: int | None) -> Path:
+    path = job.managers[type].dir_of(timestamp) / f"{md5}.bin"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(md5.encode() * 100)
+    return path
+
+
+def test_most_specific_rule_wins(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        recs, sid = [], 0
+        for gid in (1, 2, 3):
+            for type in ("text", "video", "image"):
+                for age in (100, 40, 10):
+                    sid += 1
+                    recs.append(make_rec(sid, time=NOW - age * DAY, gid=gid, type=type))
+        await add_recs(msg_db, recs)
+
+        job = _job(
+            msg_db,
+            [
+                RetentionRule(type="video", days=90),
+                RetentionRule(gid=2),
+                RetentionRule(gid=1, type="image", days=30),
+            ],
+        )
+        await job.run_once()
+
+        deleted = {(1, "video", 100), (3, "video", 100), (1, "image", 100), (1, "image", 40)}
+        expected = {
+            (gid, type, age)
+            for gid in (1, 2, 3)
+            for type in ("text", "video", "image")
+            for age in (100, 40, 10)
+        }
+        assert await _rows(msg_db) == expected - deleted
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_duplicate_rules_are_rejected(msg_db: MsgDB) -> None:
+    with pytest.raises(ValueError):
+        _job(msg_db, [RetentionRule(type="video", days=1), RetentionRule(type="video")])
+
+
+def test_batches_advance_past_retained_rows(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        old = NOW - 10 * DAY
+        recs = [make_rec(i, time=old + i // 3, type="text") for i in range(1, 301)]
+        recs += [make_rec(i, time=old + i // 3, type="video") for i in range(301, 356)]
+        recs += [make_rec(i, time=NOW, type="video") for i in range(356, 366)]
+        await add_recs(msg_db, recs)
+
+        job = _job(msg_db, [RetentionRule(type="video", days=1)], batch_size=10)
+        batches = 0
+        origin = job.throttle
+
+        async def counted() -> None:
+            nonlocal batches
+            batches += 1
+            await origin()
+
+        job.throttle = counted  # type: ignore[method-assign]
+        assert await job.expire(job.rules[0], NOW - DAY) == 55
+        # 6 批删除，加上一次确认已无剩余的查询
+        assert batches == 7
+
+        rows = await fetch(msg_db, "select type, count(*) as n from segments group by type")
+        assert {r.type: r.n for r in rows} == {"text": 300, "video": 10}
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_archive_keeps_files_referenced_in_same_month(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        old = NOW - 100 * DAY
+        job = _job(msg_db, [RetentionRule(gid=1, type="image", days=30)])
+        paths = {md5: _store_file(job, "image", md5, old) for md5 in ("shared", "alone", "dup")}
+        await add_recs(
+            msg_db,
+            [
+                make_rec(1, time=old, gid=1, type="image", data="shared"),
+                make_rec(2, time=old, gid=2, type="image", data="shared"),
+                make_rec(3, time=old, gid=1, type="image", data="alone"),
+                make_rec(4, time=old, gid=1, type="image", data="dup"),
+                make_rec(5, time=old + 1, gid=1, type="image", data="dup"),
+            ],
+        )
+        await job.run_once()
+
+        assert {r.sid for r in await fetch(msg_db, "select sid from segments")} == {2}
+        assert paths["shared"].exists()
+        cold = (
+            msg_db.cold_dir
+            / "images"
+            / paths["alone"].parent.relative_to(job.managers["image"].root)
+        )
+        for md5 in ("alone", "dup"):
+            assert not paths[md5].exists()
+            with gzip.open(cold / f"{md5}.bin.gz") as fp:
+                assert fp.read() == md5.encode() * 100
+        assert not (cold / "shared.bin.gz").exists()
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def _forward_recs(old: int) -> list[Record]:
+    """群 1 的旧转发消息内有视频、文本与嵌套转发，群 2 的新转发消息也引用了同一张图片"""
+
+    def node(sid: int, eid: int, type: str, **kwargs: Any) -> Record:
+        return make_rec(sid, eid=eid, mid=None, time=None, gid=None, type=type, **kwargs)
+
+    return [
+        make_rec(1, time=old, gid=1, type="forward", data=repr([100, 101, 102])),
+        node(2, 100, "video", data="v1"),
+        node(3, 101, "text"),
+        node(4, 102, "forward", data=repr([200])),
+        node(5, 200, "image", data="i1"),
+        node(6, 200, "text", idx=1),
+        make_rec(7, time=NOW, gid=2, type="forward", data=repr([300])),
+        node(8, 300, "video", data="v2"),
+        node(9, 300, "image", data="i1", idx=1),
+    ]
+
+
+def test_forwarded_segments_follow_parent_time_and_gid(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        job = _job(
+            msg_db, [RetentionRule(type="video", days=30), RetentionRule(type="image", days=30)]
+        )
+        files = {
+            md5: _store_file(job, type, md5, None)
+            for type, md5 in (("video", "v1"), ("video", "v2"), ("image", "i1"))
+        }
+        await add_recs(msg_db, _forward_recs(NOW - 100 * DAY))
+        await job.run_once()
+
+        kept = {r.sid for r in await fetch(msg_db, "select sid from segments")}
+        # 旧转发中的视频与嵌套转发中的图片过期，文本与转发消息段本身保留
+        assert kept == {1, 3, 4, 6, 7, 8, 9}
+        assert not files["v1"].exists()
+        with gzip.open(msg_db.cold_dir / "videos" / "none" / "v1.bin.gz") as fp:
+            assert fp.read() == b"v1" * 100
+        # 图片仍被群 2 转发消息中的消息段引用
+        assert files["i1"].exists() and files["v2"].exists()
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_expired_forward_removes_all_descendants(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        old = NOW - 100 * DAY
+        job = _job(msg_db, [RetentionRule(gid=1, days=30)])
+        files = {md5: _store_file(job, "image", md5, None) for md5 in ("i1", "i2")}
+        recs = _forward_recs(old)
+        recs.append(make_rec(10, eid=200, mid=None, time=None, gid=None, type="image", data="i2"))
+        await add_recs(msg_db, recs)
+        await job.run_once()
+
+        assert {r.sid for r in await fetch(msg_db, "select sid from segments")} == {7, 8, 9}
+        assert files["i1"].exists() and not files["i2"].exists()
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_archive_failure_keeps_rows_for_retry(
+    msg_db: MsgDB, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        old = NOW - 100 * DAY
+        job = _job(msg_db, [RetentionRule(type="video", days=30)])
+        path = _store_file(job, "video", "clip", old)
+        await add_recs(msg_db, [make_rec(1, time=old, type="video", data="clip")])
+
+        def fail(*_: object) -> bool:
+            raise OSError("disk full")
+
+        manager = job.managers["video"]
+        monkeypatch.setattr(manager, "archive", fail)
+        with pytest.raises(OSError):
+            await job.run_once()
+        assert len(await fetch(msg_db, "select sid from segments")) == 1
+        assert path.exists()
+
+        monkeypatch.delattr(manager, "archive")
+        await job.run_once()
+        assert not await fetch(msg_db, "select sid from segments")
+        assert not path.exists()
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())
+
+
+def test_vacuum_step_frees_requested_pages(msg_db: MsgDB) -> None:
+    async def main() -> None:
+        await msg_db.start()
+        await add_recs(msg_db, [make_rec(i, text="x" * 2000) for i in range(1, 1001)])
+        async with msg_db.engine.begin() as conn:
+            await conn.exec_driver_sql("delete from segments")
+
+        async def free() -> int:
+            (row,) = await fetch(msg_db, "PRAGMA freelist_count")
+            return int(row[0])
+
+        job = _job(msg_db, [], vacuum_pages=64)
+        before = await free()
+        assert before > 2 * 64
+        assert await job.vacuum_step()
+        assert await free() == before - 64
+
+        await job.vacuum()
+        assert await free() == 0
+        await msg_db.engine.dispose()
+
+    asyncio.run(main())